@@ -1,11 +1,22 @@
+import atexit
+import collections
+import copy
 import datetime as dt
 import logging
+import os
+import sys
 import threading
+import time
 
+import bson
+from bson.raw_bson import RawBSONDocument
 from pymongo import MongoClient
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError
 from pymongo.errors import OperationFailure
 from pymongo.errors import ServerSelectionTimeoutError
+from pymongo.operations import InsertOne
+from pymongo.write_concern import WriteConcern
 
 """
 Example format of generated bson document:
@@ -32,18 +43,22 @@ Example format of generated bson document:
 }
 """
 _connection = None
+_utcfromtimestamp = dt.datetime.utcfromtimestamp
+_LEVEL_DEBUG = logging.getLevelName(logging.DEBUG)
+_writer = None
+_writer_lock = threading.Lock()
 
 
 class MongoFormatter(logging.Formatter):
 
-    DEFAULT_PROPERTIES = logging.LogRecord(
-        '', '', '', '', '', '', '', '').__dict__.keys()
+    DEFAULT_PROPERTIES = frozenset(logging.LogRecord(
+        '', '', '', '', '', '', '', '').__dict__)
 
     def format(self, record):
         """Formats LogRecord into python dictionary."""
         # Standard document
         document = {
-            'timestamp': dt.datetime.utcnow(),
+            'timestamp': _utcfromtimestamp(record.created),
             'level': record.levelname,
             'thread': record.thread,
             'threadName': record.threadName,
@@ -65,21 +80,161 @@ class MongoFormatter(logging.Formatter):
             })
         # Standard document decorated with extra contextual information
         if len(self.DEFAULT_PROPERTIES) != len(record.__dict__):
-            contextual_extra = set(record.__dict__).difference(
-                set(self.DEFAULT_PROPERTIES))
-            if contextual_extra:
-                for key in contextual_extra:
-                    document[key] = record.__dict__[key]
+            contextual_extra = [key for key in record.__dict__
+                                if key not in self.DEFAULT_PROPERTIES]
+            for key in contextual_extra:
+                document[key] = record.__dict__[key]
         return document
 
 
+class BackgroundWriter(object):
+
+    STOP_TIMEOUT = 10.0
+
+    def __init__(self, batch_size=200):
+        """
+        Writer draining documents queued by handlers into mongo database
+        from a single daemon thread.
+
+        Documents queued concurrently by any number of handlers are coalesced
+        into insert_many calls of up to batch_size documents per collection.
+        """
+        self.batch_size = batch_size
+        self.queue = collections.deque()
+        self.condition = threading.Condition()
+        self.pending = 0
+        self.stopped = False
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, handler, record, document):
+        """Queue formatted document for writing and return immediately."""
+        with self.condition:
+            self.queue.append((handler, record, document))
+            self.pending += 1
+            self.condition.notify_all()
+
+    def flush(self, timeout=None):
+        """
+        Block until every queued document has been written, or at most
+        timeout seconds.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while self.pending and self.thread.is_alive():
+                wait = 0.1
+                if deadline is not None:
+                    wait = min(wait, deadline - time.monotonic())
+                    if wait <= 0:
+                        return
+                self.condition.wait(wait)
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        """
+        Drain the queue and stop the writer thread, waiting at most timeout
+        seconds so that an unreachable server cannot hang the exit.
+        """
+        with self.condition:
+            self.stopped = True
+            self.condition.notify_all()
+        self.thread.join(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.stopped:
+                    self.condition.wait()
+                if not self.queue:
+                    return
+                size = min(self.batch_size, len(self.queue))
+                batch = [self.queue.popleft() for _ in range(size)]
+            try:
+                self._write(batch)
+            finally:
+                with self.condition:
+                    self.pending -= len(batch)
+                    self.condition.notify_all()
+
+    def _write(self, batch):
+        """Write batch grouped by handler, one insert_many per handler."""
+        by_handler = collections.OrderedDict()
+        for handler, record, document in batch:
+            by_handler.setdefault(handler, []).append((record, document))
+        for handler, entries in by_handler.items():
+            documents = [document for _, document in entries]
+            try:
+                handler.collection.insert_many(
+                    _encode_documents(handler.collection, documents),
+                    ordered=False)
+            except BulkWriteError as e:
+                # unordered insert went past failures, report only the failed records
+                if not handler.fail_silently:
+                    for error in e.details['writeErrors']:
+                        handler.handleError(entries[error['index']][0])
+            except Exception:
+                # retry once, reporting the records failing again with the original error
+                failures = _retry_documents(handler.collection, documents)
+                if not handler.fail_silently:
+                    for index, _ in failures:
+                        handler.handleError(entries[index][0])
+
+
+def _encode_documents(collection, documents):
+    """
+    Encode documents to BSON with the collection codec options, so that
+    pymongo sends them as they are instead of encoding them on insert.
+    """
+    codec_options = collection.codec_options
+    return [RawBSONDocument(bson.encode(document, codec_options=codec_options))
+            for document in documents]
+
+
+def _retry_documents(collection, documents):
+    """
+    Retry writing documents in a single unordered bulk write and return the
+    failures as (index, error) pairs. Documents are encoded one-by-one, so
+    that a document failing to encode does not fail the others.
+    """
+    failures = []
+    retry = []
+    for index, document in enumerate(documents):
+        try:
+            retry.append((index, _encode_documents(collection, [document])[0]))
+        except Exception as e:
+            failures.append((index, e))
+    if retry:
+        try:
+            collection.bulk_write([InsertOne(raw) for _, raw in retry], ordered=False)
+        except BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                failures.append((retry[error['index']][0], error['errmsg']))
+        except Exception as e:
+            failures.extend((index, e) for index, _ in retry)
+    failures.sort(key=lambda failure: failure[0])
+    return failures
+
+
+def get_background_writer():
+    """Return the process wide BackgroundWriter, starting it if needed."""
+    global _writer
+    with _writer_lock:
+        # the thread of a writer inherited through fork is not running
+        if _writer is None or not _writer.thread.is_alive():
+            _writer = BackgroundWriter()
+            atexit.register(_writer.stop)
+        return _writer
+
+
 class MongoHandler(logging.Handler):
 
     def __init__(self, level=logging.NOTSET, host='localhost', port=27017,
                  database_name='logs', collection='logs',
                  username=None, password=None, authentication_db='admin',
                  fail_silently=False, formatter=None, capped=False,
-                 capped_max=1000, capped_size=1000000, reuse=True, **kwargs):
+                 capped_max=1000, capped_size=1000000, reuse=True,
+                 background=False, write_concern=None, max_pool_size=None,
+                 compressors=None, **kwargs):
         """
         Setting up mongo handler, initializing mongo database connection via
         pymongo.
@@ -91,6 +246,22 @@ class MongoHandler(logging.Handler):
         The default is True. As such a program with multiple handlers
         that log to mongodb will have those handlers share a single connection
         to MongoDB.
+
+        If background is set to True, emit only queues the formatted record
+        and a single background thread shared by all handlers writes queued
+        records with insert_many. Queued records are written at exit.
+
+        If write_concern is set, it is used as the w option of the log
+        collection write concern. write_concern=0 makes writes
+        unacknowledged: no server round trip is awaited, but failed writes
+        go unnoticed. This pairs well with capped collections, where old
+        records are discarded anyway.
+
+        max_pool_size sets the maximum number of connections of the
+        MongoClient pool, raise it when many threads log concurrently.
+        compressors is a list of wire protocol compressors, e.g.
+        ['zstd', 'snappy'], log documents compress well. Both only apply
+        when a new MongoClient is created.
         """
         logging.Handler.__init__(self, level)
         self.host = host
@@ -110,6 +281,10 @@ class MongoHandler(logging.Handler):
         self.capped_max = capped_max
         self.capped_size = capped_size
         self.reuse = reuse
+        self.background = background
+        self.write_concern = write_concern
+        self.max_pool_size = max_pool_size
+        self.compressors = compressors
         self._connect(**kwargs)
 
     def _connect(self, **kwargs):
@@ -118,6 +293,10 @@ class MongoHandler(logging.Handler):
         if self.reuse and _connection:
             self.connection = _connection
         else:
+            if self.max_pool_size is not None:
+                kwargs['maxPoolSize'] = self.max_pool_size
+            if self.compressors is not None:
+                kwargs['compressors'] = self.compressors
             self.connection = MongoClient(host=self.host, port=self.port,
                                           **kwargs)
             try:
@@ -148,10 +327,17 @@ class MongoHandler(logging.Handler):
         else:
             self.collection = self.db[self.collection_name]
 
+        if self.write_concern is not None:
+            self.collection = self.collection.with_options(
+                write_concern=WriteConcern(w=self.write_concern))
+
     def close(self):
         """
         If authenticated, logging out and closing mongo database connection.
         """
+        # once the writer is stopped at exit, its atexit hook has already waited for the queue
+        if self.background and _writer is not None and not _writer.stopped:
+            _writer.flush(timeout=BackgroundWriter.STOP_TIMEOUT)
         if self.authenticated:
             self.db.logout()
         if self.connection is not None:
@@ -161,6 +347,10 @@ class MongoHandler(logging.Handler):
         """Inserting new logging record to mongo database."""
         if self.collection is not None:
             try:
+                if self.background:
+                    get_background_writer().put(self, record,
+                                                self.format(record))
+                    return
                 self.collection.insert_one(self.format(record))
             except Exception:
                 if not self.fail_silently:
@@ -170,15 +360,95 @@ class MongoHandler(logging.Handler):
         self.close()
 
 
+class PeriodicalFlusher(object):
+
+    def __init__(self):
+        """
+        Single thread flushing every registered buffered handler at its own
+        buffer_periodical_flush_timing interval.
+
+        The thread is a daemon, so it keeps flushing as long as any other
+        thread may still be logging. The final flush at exit is done by the
+        destroy() atexit handler of each handler, which runs once all
+        non-daemon threads are over.
+        """
+        # handler -> next flush time, handlers are unregistered by destroy()
+        self.handlers = {}
+        self.condition = threading.Condition()
+        self.stopped = False
+        self.thread = threading.Thread(target=self._loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, handler):
+        """Register handler, its first flush is in one interval."""
+        with self.condition:
+            self.handlers[handler] = time.monotonic() + handler.buffer_periodical_flush_timing
+            self.condition.notify()
+
+    def remove(self, handler):
+        """Unregister handler and return the number of handlers left."""
+        with self.condition:
+            self.handlers.pop(handler, None)
+            return len(self.handlers)
+
+    def stop(self, timeout=None):
+        """Stop the thread and wait for it to exit."""
+        with self.condition:
+            self.stopped = True
+            self.condition.notify()
+        if self.thread is not threading.current_thread():
+            self.thread.join(timeout=timeout)
+
+    def _loop(self):
+        while True:
+            with self.condition:
+                if not self.stopped:
+                    self.condition.wait(self._next_wait())
+                if self.stopped:
+                    return
+                now = time.monotonic()
+                due = [handler for handler, next_flush in self.handlers.items() if next_flush <= now]
+                for handler in due:
+                    self.handlers[handler] = now + handler.buffer_periodical_flush_timing
+            for handler in due:
+                self._flush(handler)
+
+    def _next_wait(self):
+        """Seconds until the next handler is due, None to wait for one to be added."""
+        next_flush = min(self.handlers.values(), default=None)
+        if next_flush is None:
+            return None
+        return max(0.0, next_flush - time.monotonic())
+
+    def _flush(self, handler):
+        try:
+            handler.flush_to_mongo()
+        except Exception:
+            # keep flushing the other handlers
+            if not handler.fail_silently and handler.last_record is not None:
+                handler.handleError(handler.last_record)
+
+
 class BufferedMongoHandler(MongoHandler):
 
+    COALESCE_KEYS = ('level', 'loggerName', 'message', 'module', 'lineNumber')
+    ERROR_RING_SIZE = 256
+
+    # periodical flush thread shared by all buffered handlers
+    _scheduler = None
+    _scheduler_lock = threading.Lock()
+
     def __init__(self, level=logging.NOTSET, host='localhost', port=27017,
                  database_name='logs', collection='logs',
                  username=None, password=None, authentication_db='admin',
                  fail_silently=False, formatter=None, capped=False,
                  capped_max=1000, capped_size=1000000, reuse=True,
                  buffer_size=100, buffer_periodical_flush_timing=5.0,
-                 buffer_early_flush_level=logging.CRITICAL, **kwargs):
+                 buffer_early_flush_level=logging.CRITICAL, write_concern=None,
+                 max_pool_size=None, compressors=None,
+                 coalesce_duplicates=False, buffer_size_range=None,
+                 buffer_flush_target_timing=0.05, **kwargs):
         """
         Setting up buffered mongo handler, initializing mongo database connection via
         pymongo.
@@ -190,90 +460,235 @@ class BufferedMongoHandler(MongoHandler):
         It means that buffered messages might be stuck here for a while until the buffer full or
         a critical message is sent (both causing flush).
 
-        If buffer_periodical_flush_timer is set to numeric value, a thread with timer will be launched
-        to call the buffer flush periodically.
+        If buffer_periodical_flush_timer is set to numeric value, the buffer is flushed periodically by a
+        thread shared by all buffered handlers. It is launched with the first such handler and stopped
+        when the last one is destroyed.
+
+        If coalesce_duplicates is set to True, consecutive buffered messages with the same level, logger,
+        message, module and line number are written as a single document carrying the number of
+        occurrences in count and the first and last timestamps in firstTimestamp and lastTimestamp.
+
+        If buffer_size_range is set to a (min, max) tuple, buffer_size is brought into and adapted within these bounds
+        to keep the duration of a full buffer write close to buffer_flush_target_timing seconds:
+        it is doubled while writes take less than half of it and halved while they take more than twice.
         """
 
         MongoHandler.__init__(self, level=level, host=host, port=port, database_name=database_name, collection=collection,
                               username=username, password=password, authentication_db=authentication_db,
                               fail_silently=fail_silently, formatter=formatter, capped=capped, capped_max=capped_max,
-                              capped_size=capped_size, reuse=reuse, **kwargs)
-        self.buffer = []
+                              capped_size=capped_size, reuse=reuse, write_concern=write_concern,
+                              max_pool_size=max_pool_size, compressors=compressors, **kwargs)
+        self.buffer = collections.deque()
         self.buffer_size = buffer_size
         self.buffer_periodical_flush_timing = buffer_periodical_flush_timing
         self.buffer_early_flush_level = buffer_early_flush_level
+        self.coalesce_duplicates = coalesce_duplicates
+        self.buffer_size_range = buffer_size_range
+        if self.buffer_size_range:
+            buffer_size_min, buffer_size_max = self.buffer_size_range
+            self.buffer_size = min(max(self.buffer_size, buffer_size_min), buffer_size_max)
+        self.buffer_flush_target_timing = buffer_flush_target_timing
         self.last_record = None #kept for handling the error on flush
-        self.buffer_timer_thread = None
-
-        self.buffer_lock = threading.RLock()
 
-        self._timer_stopper = None
+        self.buffer_lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self._local = threading.local()
+        self._flushing = collections.deque()
+        self._error_ring = collections.deque(maxlen=self.ERROR_RING_SIZE)
 
         # setup periodical flush
         if self.buffer_periodical_flush_timing:
 
             # clean exit event
-            import atexit
             atexit.register(self.destroy)
 
-            # call at interval function
-            def call_repeatedly(interval, func, *args):
-                stopped = threading.Event()
-
-                # actual thread function
-                def loop():
-                    while not stopped.wait(interval):  # the first call is in `interval` secs
-                        func(*args)
-
-                timer_thread = threading.Thread(target=loop)
-                timer_thread.daemon = True
-                timer_thread.start()
-                return stopped.set, timer_thread
-
-            # launch thread
-            self._timer_stopper, self.buffer_timer_thread = call_repeatedly(self.buffer_periodical_flush_timing, self.flush_to_mongo)
+            with BufferedMongoHandler._scheduler_lock:
+                scheduler = BufferedMongoHandler._scheduler
+                # the thread of a scheduler inherited through fork is not running
+                if scheduler is None or not scheduler.thread.is_alive():
+                    BufferedMongoHandler._scheduler = PeriodicalFlusher()
+                BufferedMongoHandler._scheduler.add(self)
 
     def emit(self, record):
         """Inserting new logging record to buffer and flush if necessary."""
 
+        entry = self.prepare(record)
+        record = entry[0]
+        early_flush = record.levelno >= self.buffer_early_flush_level
+        buffer_size = self.buffer_size
         with self.buffer_lock:
             self.last_record = record
-            self.buffer.append(self.format(record))
+            # the buffer is swapped on flush, it is only bound under the lock
+            buffer = self.buffer
+            buffer.append(entry)
+            should_flush = early_flush or len(buffer) >= buffer_size
 
-        if len(self.buffer) >= self.buffer_size or record.levelno >= self.buffer_early_flush_level:
+        if should_flush:
             self.flush_to_mongo()
 
+    def prepare(self, record):
+        """
+        Return the (record, message, exception) buffer entry of the record.
+        The record is formatted later when the buffer is flushed and its args
+        may have been mutated by then, so the message is frozen now.
+        The exception is rendered now, so that the traceback is not kept
+        alive in the buffer.
+        """
+        message = record.getMessage()
+        exception = None
+        if record.exc_info is not None:
+            exception = {
+                'message': str(record.exc_info[1]),
+                'code': 0,
+                'stackTrace': self.formatter.formatException(record.exc_info)
+            }
+            # only records with exception are copied, the original is shared with other handlers
+            record = copy.copy(record)
+            record.exc_info = None
+        return record, message, exception
+
     def flush_to_mongo(self):
         """Flush all records to mongo database."""
 
-        # we have to acquire buffer lock already for the check. otherwise, its state can change
-        with self.buffer_lock:
-            if self.collection is not None and len(self.buffer) > 0:
+        # logging during the write (e.g. pymongo debug logs) re-enters emit on this thread,
+        # it must not wait for the flush lock it already holds. the records stay buffered
+        if getattr(self._local, 'flushing', False):
+            return
+
+        # one flush at a time, the flushing buffer is reused by the next one
+        with self.flush_lock:
+            self._local.flushing = True
+            try:
+                # we have to acquire buffer lock already for the check. otherwise, its state can change.
+                # buffers are swapped under the lock, so emitting threads are not blocked by the write
+                with self.buffer_lock:
+                    if self.collection is None or len(self.buffer) == 0:
+                        return
+                    self.buffer, self._flushing = self._flushing, self.buffer
                 try:
-                    self.collection.insert_many(self.buffer)
-                except Exception as e1:
-                    # try to insert one-by-one and catch exception. this is from MH
-                    for msg in self.buffer:
-                        try:
-                            self.collection.insert_one(msg)
-                        except Exception as e2:
-                            if msg['levelname'] != 'DEBUG':
-                                print(f'flush_to_mongo failed\n'
-                                      f'{e1}\n'
-                                      f'{e2}\n'
-                                      f'Message: {msg}')
-
-                # clear buffer now
-                self.empty_buffer()
+                    self._write_batch(self._flushing)
+                finally:
+                    self._flushing.clear()
+            finally:
+                self._local.flushing = False
+
+    def _write_batch(self, batch):
+        """Format detached batch of records and write it to mongo database."""
+        size = len(batch)
+        documents = []
+        for record, message, exception in batch:
+            try:
+                document = self.format(record)
+            except Exception:
+                if not self.fail_silently:
+                    self.handleError(record)
+                continue
+            document['message'] = message
+            if exception is not None:
+                document['exception'] = exception
+            documents.append(document)
+        if not documents:
+            return
+        if self.coalesce_duplicates:
+            documents = self.coalesce(documents)
+        batch = documents
+
+        start = time.monotonic()
+        try:
+            self.collection.insert_many(_encode_documents(self.collection, batch), ordered=False)
+        except BulkWriteError as e1:
+            # unordered insert went past failures, report only the failed messages
+            for error in e1.details['writeErrors']:
+                self._report_failure(e1, error['errmsg'], batch[error['index']])
+        except Exception as e1:
+            # retry once in a single unordered bulk write. documents are encoded one-by-one,
+            # so that a document failing to encode does not fail the others. this is from MH
+            for index, e2 in _retry_documents(self.collection, batch):
+                self._report_failure(e1, e2, batch[index])
+        else:
+            if self.buffer_size_range:
+                self.adapt_buffer_size(size, time.monotonic() - start)
+
+    def _report_failure(self, e1, e2, msg):
+        """Keep the failure to write msg in the error ring, unless it is a debug message."""
+        if msg.get('level') != _LEVEL_DEBUG:
+            self._error_ring.append((time.time(), str(e1), str(e2), msg))
+
+    def adapt_buffer_size(self, size, elapsed):
+        """Adapt buffer size to the time it took to write size records."""
+        buffer_size_min, buffer_size_max = self.buffer_size_range
+        target = self.buffer_flush_target_timing
+        # partial batches written by the periodical flush say nothing about a full buffer
+        if elapsed < target / 2 and size >= self.buffer_size and self.buffer_size < buffer_size_max:
+            self.buffer_size = min(self.buffer_size * 2, buffer_size_max)
+        elif elapsed > target * 2 and self.buffer_size > buffer_size_min:
+            self.buffer_size = max(self.buffer_size // 2, buffer_size_min)
+
+    def coalesce(self, documents):
+        """Collapse runs of consecutive duplicate documents into one document with a count."""
+        runs = []
+        last_key = None
+        for document in documents:
+            key = tuple(document.get(name) for name in self.COALESCE_KEYS)
+            if runs and key == last_key:
+                runs[-1][1] += 1
+                runs[-1][2] = document.get('timestamp')
+            else:
+                runs.append([document, 1, None])
+                last_key = key
+
+        coalesced = []
+        for document, count, last_timestamp in runs:
+            if count > 1:
+                document['count'] = count
+                document['firstTimestamp'] = document.get('timestamp')
+                document['lastTimestamp'] = last_timestamp
+            coalesced.append(document)
+        return coalesced
+
+    def get_errors(self):
+        """
+        Return the most recent flush failures, oldest first, as a list of
+        (time, error, message error, message) tuples.
+        """
+        return list(self._error_ring)
 
     def empty_buffer(self):
         """Empty the buffer list."""
-        del self.buffer
-        self.buffer = []
+        with self.buffer_lock:
+            self.buffer.clear()
 
     def destroy(self):
         """Clean quit logging. Flush buffer. Stop the periodical thread if needed."""
-        if self._timer_stopper:
-            self._timer_stopper()
+        if self.buffer_periodical_flush_timing:
+            with BufferedMongoHandler._scheduler_lock:
+                scheduler = BufferedMongoHandler._scheduler
+                if scheduler is not None and not scheduler.remove(self):
+                    # last handler gone, stop the shared thread
+                    BufferedMongoHandler._scheduler = None
+                else:
+                    scheduler = None
+            if scheduler is not None:
+                scheduler.stop(timeout=self.buffer_periodical_flush_timing * 2)
         self.flush_to_mongo()
         self.close()
+        # report flush failures nobody has looked at
+        for _, e1, e2, msg in self.get_errors():
+            print(f'flush_to_mongo failed\n'
+                  f'{e1}\n'
+                  f'{e2}\n'
+                  f'Message: {msg}', file=sys.stderr)
+        self._error_ring.clear()
+
+
+def _reset_after_fork():
+    """Threads do not survive fork, the child process starts its own."""
+    global _writer, _writer_lock
+    _writer = None
+    _writer_lock = threading.Lock()
+    BufferedMongoHandler._scheduler = None
+    BufferedMongoHandler._scheduler_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_after_fork)
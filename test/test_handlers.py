@@ -4,6 +4,7 @@ import logging
 import time
 import sys
 import threading
+from unittest import mock
 
 from pymongo.errors import ServerSelectionTimeoutError
 
@@ -97,6 +98,27 @@ class TestMongoHandler(unittest.TestCase):
         self.log.warning('test warming')
         self.assertEqual(sys.stderr.getvalue(), '')
 
+    def test_write_concern(self):
+        handler = MongoHandler(host=self.host_name,
+                               database_name=self.database_name,
+                               collection=self.collection_name,
+                               write_concern=0)
+        self.assertEqual(handler.collection.write_concern.document, {'w': 0})
+        handler.close()
+
+    def test_connection_options(self):
+        connection = log4mongo.handlers._connection
+        try:
+            with mock.patch.object(log4mongo.handlers, 'MongoClient') as client:
+                MongoHandler(host=self.host_name,
+                             database_name=self.database_name,
+                             collection=self.collection_name,
+                             reuse=False, max_pool_size=10, compressors=['zlib'])
+            client.assert_called_once_with(host=self.host_name, port=27017,
+                                           maxPoolSize=10, compressors=['zlib'])
+        finally:
+            log4mongo.handlers._connection = connection
+
     def test_contextual_info(self):
         self.log.info('test message with contextual info',
                       extra={'ip': '127.0.0.1', 'host': 'localhost'})
@@ -189,6 +211,79 @@ class TestCappedMongoHandler(TestMongoHandler):
         self.assertEqual(document['level'], 'WARNING')
 
 
+class TestBackgroundMongoHandler(TestMongoHandler):
+    collection_name = 'background_logs_test'
+
+    def setUp(self):
+        self.handler = MongoHandler(host=self.host_name,
+                                    database_name=self.database_name,
+                                    collection=self.collection_name,
+                                    background=True)
+        self.log = logging.getLogger('testLogger')
+        self.log.setLevel(logging.DEBUG)
+        self.log.addHandler(self.handler)
+        self.old_stderr = sys.stdout
+        sys.stderr = StringIO()
+
+    def force_flush(self):
+        log4mongo.handlers.get_background_writer().flush()
+
+    def test_emit(self):
+        self.log.warning('test message')
+        self.force_flush()
+        document = self.handler.collection.find_one(
+            {'message': 'test message', 'level': 'WARNING'})
+        self.assertEqual(document['message'], 'test message')
+        self.assertEqual(document['level'], 'WARNING')
+
+    def test_emit_exception(self):
+        try:
+            raise Exception('exc1')
+        except:
+            self.log.exception('test message')
+        self.force_flush()
+
+        document = self.handler.collection.find_one(
+            {'message': 'test message', 'level': 'ERROR'})
+        self.assertEqual(document['message'], 'test message')
+        self.assertEqual(document['level'], 'ERROR')
+        self.assertEqual(document['exception']['message'], 'exc1')
+
+    def test_emit_fail(self):
+        self.handler.collection = ''
+        self.log.warning('test warning')
+        self.force_flush()
+        val = sys.stderr.getvalue()
+        self.assertRegexpMatches(val, r"AttributeError: 'str' object has no attribute")
+
+    def test_contextual_info(self):
+        self.log.info('test message with contextual info',
+                      extra={'ip': '127.0.0.1', 'host': 'localhost'})
+        self.force_flush()
+        document = self.handler.collection.find_one(
+            {'message': 'test message with contextual info', 'level': 'INFO'})
+        self.assertEqual(document['ip'], '127.0.0.1')
+        self.assertEqual(document['host'], 'localhost')
+
+    def test_contextual_info_adapter(self):
+        adapter = logging.LoggerAdapter(self.log,
+                                        {'ip': '127.0.0.1',
+                                         'host': 'localhost'})
+        adapter.info('test message with contextual info')
+        self.force_flush()
+        document = self.handler.collection.find_one(
+            {'message': 'test message with contextual info', 'level': 'INFO'})
+        self.assertEqual(document['ip'], '127.0.0.1')
+        self.assertEqual(document['host'], 'localhost')
+
+    def test_background_batch(self):
+        for i in range(500):
+            self.log.info('test background batch')
+        self.force_flush()
+        doc_amount = self.handler.collection.count_documents({'message': 'test background batch'})
+        self.assertEqual(doc_amount, 500, "All queued records should have been written to database")
+
+
 class TestBufferedMongoHandler(TestMongoHandler):
     collection_name = 'buffered_logs_test'
 
@@ -258,8 +353,9 @@ class TestBufferedMongoHandler(TestMongoHandler):
         self.handler.collection = ''
         self.log.warn('test warning')
         self.force_flush()
-        val = sys.stderr.getvalue()
-        self.assertRegexpMatches(val, r"AttributeError: 'str' object has no attribute '{}'".format(write_many_method))
+        errors = self.handler.get_errors()
+        self.assertEqual(len(errors), 1)
+        self.assertRegexpMatches(errors[0][2], r"'str' object has no attribute")
 
     def test_buffer(self):
         self.force_flush()
@@ -315,6 +411,95 @@ class TestBufferedMongoHandler(TestMongoHandler):
                                                      'level': 'CRITICAL'}).count()
         self.assertEqual(doc_amount, 1, "One CRITICAL message should have been written to database")
 
+    def test_buffer_exception_rendered(self):
+        try:
+            raise Exception('exc1')
+        except:
+            self.log.exception('test buffered exception')
+        record, _, exception = self.handler.buffer[0]
+        self.assertIsNone(record.exc_info, "Traceback should not be kept in the buffer")
+        self.assertEqual(exception['message'], 'exc1')
+        self.force_flush()
+
+        document = self.handler.collection.find_one({'message': 'test buffered exception'})
+        self.assertEqual(document['exception']['message'], 'exc1')
+        self.assertIn('Exception: exc1', document['exception']['stackTrace'])
+
+    def test_flush_retry_bad_document(self):
+        self.log.info('test retry message')
+        self.log.info('test retry bad message', extra={'unencodable': object()})
+        self.log.info('test retry message')
+        self.force_flush()
+
+        doc_amount = self.handler.collection.count_documents({'message': 'test retry message'})
+        self.assertEqual(doc_amount, 2, "Encodable messages should have been written to database")
+        errors = self.handler.get_errors()
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(errors[0][3]['message'], 'test retry bad message')
+
+    def test_flush_reentrant_logging(self):
+        handler = self.handler
+        log = self.log
+        collection = handler.collection
+
+        class LoggingCollection(object):
+            codec_options = collection.codec_options
+
+            def insert_many(self, documents, ordered=True):
+                # e.g. pymongo debug logs reaching the handler during the write
+                for i in range(handler.buffer_size):
+                    log.critical('test reentrant message')
+                return collection.insert_many(documents, ordered=ordered)
+
+        handler.collection = LoggingCollection()
+        self.log.info('test reentrant message')
+        thread = threading.Thread(target=handler.flush_to_mongo)
+        thread.start()
+        thread.join(5)
+        handler.collection = collection
+        self.assertFalse(thread.is_alive(), "Flush should not deadlock on logging during the write")
+
+        self.force_flush()
+        doc_amount = self.handler.collection.count_documents({'message': 'test reentrant message'})
+        self.assertEqual(doc_amount, handler.buffer_size + 1, "Records logged during the write should be kept")
+
+    def test_coalesce_duplicates(self):
+        self.handler.coalesce_duplicates = True
+        self.log.info('test coalesce message')
+        self.log.info('test coalesce message')
+        self.log.info('test coalesce message')
+        self.log.info('test coalesce other message')
+        self.force_flush()
+
+        doc_amount = self.handler.collection.count_documents({'message': 'test coalesce message'})
+        self.assertEqual(doc_amount, 1, "Duplicates should have been written as one document")
+        document = self.handler.collection.find_one({'message': 'test coalesce message'})
+        self.assertEqual(document['count'], 3)
+        self.assertLessEqual(document['firstTimestamp'], document['lastTimestamp'])
+
+        document = self.handler.collection.find_one({'message': 'test coalesce other message'})
+        self.assertNotIn('count', document)
+
+    def test_buffer_size_clamped_to_range(self):
+        handler = BufferedMongoHandler(host=self.host_name,
+                                       database_name=self.database_name,
+                                       collection=self.collection_name,
+                                       buffer_size=100, buffer_periodical_flush_timing=None,
+                                       buffer_size_range=(10, 50))
+        self.assertEqual(handler.buffer_size, 50, "Buffer size should be clamped to max")
+
+    def test_adapt_buffer_size(self):
+        self.handler.buffer_size_range = (2, 8)
+        self.handler.adapt_buffer_size(5, 0.001)
+        self.assertEqual(self.handler.buffer_size, 8, "Fast full write should grow the buffer up to max")
+        self.handler.adapt_buffer_size(1, 0.001)
+        self.assertEqual(self.handler.buffer_size, 8, "Partial write should not change the buffer size")
+        self.handler.adapt_buffer_size(8, 1.0)
+        self.assertEqual(self.handler.buffer_size, 4, "Slow write should shrink the buffer")
+        self.handler.adapt_buffer_size(4, 1.0)
+        self.handler.adapt_buffer_size(2, 1.0)
+        self.assertEqual(self.handler.buffer_size, 2, "Buffer should not shrink below min")
+
     def _buffer_periodical_flush(self, is_initialized_in_thread):
         def initialize():
             # Creating capped handler
@@ -351,16 +536,41 @@ class TestBufferedMongoHandler(TestMongoHandler):
         self.assertEqual(doc_amount, 2, "Should have found 2 documents written to database")
         self.assertEqual(len(self.handler_periodical.buffer), 0, "Buffer should be empty")
 
-        self.assertTrue(self.handler_periodical.buffer_timer_thread.is_alive())
+        scheduler = BufferedMongoHandler._scheduler
+        self.assertTrue(scheduler.thread.is_alive())
         self.handler_periodical.destroy()
         time.sleep(0.2)  # waiting a tiny bit so that the child thread actually exits
-        self.assertFalse(self.handler_periodical.buffer_timer_thread.is_alive(),
-                         "Child timer thread should be dead by now. Slow computer?")
+        self.assertFalse(scheduler.thread.is_alive(),
+                         "Shared timer thread should be dead by now. Slow computer?")
+        self.assertIsNone(BufferedMongoHandler._scheduler, "Shared timer should be reset")
 
         # reset to previous
         self.log.removeHandler(self.handler_periodical)
         self.log.addHandler(self.handler)
 
+    def test_buffer_periodical_flush_shared_thread(self):
+        handlers = [BufferedMongoHandler(host=self.host_name,
+                                         database_name=self.database_name,
+                                         collection=self.collection_name,
+                                         buffer_size=5, buffer_periodical_flush_timing=1.0)
+                    for _ in range(3)]
+        scheduler = BufferedMongoHandler._scheduler
+        for handler in handlers:
+            handler.emit(logging.makeLogRecord({'msg': 'test shared periodical buffer', 'levelno': logging.INFO,
+                                                'levelname': 'INFO'}))
+
+        time.sleep(1.5)  # wait a bit so the shared timer thread has flushed every handler
+
+        doc_amount = self.handler.collection.count_documents({'message': 'test shared periodical buffer'})
+        self.assertEqual(doc_amount, 3, "Each handler should have been flushed")
+
+        handlers[0].destroy()
+        self.assertTrue(scheduler.thread.is_alive(), "Shared timer thread should serve remaining handlers")
+        for handler in handlers[1:]:
+            handler.destroy()
+        time.sleep(0.2)
+        self.assertFalse(scheduler.thread.is_alive(), "Shared timer thread should stop with the last handler")
+
     def test_buffer_periodical_flush(self):
         self._buffer_periodical_flush(is_initialized_in_thread=False)
 